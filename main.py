@@ -1,13 +1,67 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.datastructures import State
+from cachetools import TTLCache
 import httpx
+import redis.asyncio as aioredis
+from PIL import Image, ImageOps, UnidentifiedImageError
+import orjson
+import xxhash
+import asyncio
 import base64
+import io
 import os
-from typing import Optional
-import json
+import random
+import re
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Optional
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the per-worker shared resources on app.state and release them
+    
+    The HTTP client keeps a pool of keep-alive connections to Groq so each
+    request skips the TCP + TLS handshake. Everything is closed on shutdown
+    so connections drain cleanly on redeploys.
+    """
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=50,
+            keepalive_expiry=30.0
+        ),
+        http2=True
+    )
+    app.state.redis = aioredis.Redis.from_url(
+        REDIS_URL,
+        decode_responses=False,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+    ) if REDIS_URL else None
+    app.state.cache = TTLCache(maxsize=2048, ttl=CACHE_TTL)
+    app.state.inflight = {}
+    app.state.groq_sem = asyncio.Semaphore(GROQ_MAX_INFLIGHT)
+    app.state.groq_waiting = 0
+    app.state.groq_inflight = 0
+    app.state.batcher = GroqBatcher(app.state, GROQ_BATCH_MAX, GROQ_BATCH_WAIT_MS)
+    
+    try:
+        yield
+    finally:
+        await app.state.batcher.aclose()
+        await app.state.http.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
 
-app = FastAPI(title="Syrian Math Tutor API")
+
+app = FastAPI(
+    title="Syrian Math Tutor API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # CORS configuration
 app.add_middleware(
@@ -24,6 +78,47 @@ if not GROQ_API_KEY:
     raise ValueError("GROQ_API_KEY environment variable is required")
 
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# Upstream concurrency limit - requests past it wait here instead of piling
+# onto Groq and tripping its rate limits. The semaphore lives in each
+# worker, so the service as a whole allows GROQ_MAX_INFLIGHT x workers
+GROQ_MAX_INFLIGHT = int(os.getenv("GROQ_MAX_INFLIGHT", "32"))
+
+# Rate-limited / overloaded replies are retried with exponential backoff
+_RETRY_STATUSES = {429, 503}
+_MAX_RETRIES = 3
+_RETRY_BASE_DELAY = 0.5
+_MAX_RETRY_DELAY = 10.0
+
+# Short standalone questions arriving within GROQ_BATCH_WAIT_MS of each other
+# are merged into one Groq call; GROQ_BATCH_MAX=1 turns batching off
+GROQ_BATCH_MAX = int(os.getenv("GROQ_BATCH_MAX", "8"))
+GROQ_BATCH_WAIT_MS = float(os.getenv("GROQ_BATCH_WAIT_MS", "10"))
+_BATCH_MAX_TOKENS = 8192
+_BATCH_INSTRUCTION = (
+    "You will receive several independent student problems as a JSON array of "
+    "{\"task_id\", \"problem\"} objects. Answer each one exactly as you would "
+    "if it were asked on its own, following all tutoring and language rules. "
+    "Reply with a JSON object of the form "
+    "{\"answers\": [{\"task_id\": <id>, \"response\": \"<answer>\"}]} "
+    "containing one answer per task.\n\n"
+)
+
+# Exact-match response cache - only deterministic (temperature 0) calls made
+# on their own are stored (never micro-batched answers), so a hit returns
+# the same answer Groq would have produced for that question alone. Each
+# worker keeps a local tier; with REDIS_URL set, answers are also shared
+# across workers and replicas through Redis
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Short socket timeouts so an unreachable Redis costs a cache miss, not a stall
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.05"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.1"))
 
 # Master Tutor System Prompt
 MASTER_TUTOR_PROMPT = """You are a revolutionary AI math tutor for Syrian students that adapts like a master teacher.
@@ -151,30 +246,617 @@ Build confidence, create mathematicians! 🚀
 
 Respond in Arabic if problem is in Arabic, English if in English, or mix as needed."""
 
+# Built once and shared by every request - keeps the prompt prefix identical
+# across calls so provider-side prefix caching can apply
+_SYSTEM_MSG = {"role": "system", "content": MASTER_TUTOR_PROMPT}
+_SYSTEM_MSG_BYTES = orjson.dumps(_SYSTEM_MSG)
+
+# Per-language instructions appended to the student's problem
+_AR_SUFFIX = "\n\nمهم: أجب بالكامل باللهجة الشامية السورية فقط!"
+_EN_SUFFIX = "\n\nProvide adaptive teaching based on the problem difficulty."
+_AR_IMAGE_INSTRUCTION = "حل هذه المسألة من الصورة بالتفصيل بالعربي."
+_EN_IMAGE_INSTRUCTION = "Solve this math problem from the image in detail."
+
+# Any character in the Arabic block marks the problem as Arabic
+_ARABIC_RE = re.compile(r"[\u0600-\u06FF]")
+
+# Uploads are base64-encoded in 3-byte aligned chunks so the raw image is
+# never held in memory next to its encoded copy
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 5 * 1024 * 1024))
+_IMAGE_CHUNK_SIZE = 3 * 21845
+
+# Image types Groq's vision model accepts, with their Pillow format names.
+# Larger images are shrunk to MAX_IMAGE_EDGE on the long edge, which also
+# cuts the vision tokens they cost
+SUPPORTED_IMAGE_TYPES = {
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+    "image/gif": "GIF",
+    "image/webp": "WEBP"
+}
+MAX_IMAGE_EDGE = int(os.getenv("MAX_IMAGE_EDGE", "1024"))
+
+# The byte limit says nothing about decoded size - a tiny PNG can declare
+# 12000x12000 pixels - so the pixel count is capped separately
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 25_000_000))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+# Model tiers - simple questions go to the fast 8B model, anything with
+# equations or calculus notation goes to the 70B model
+SPEED_MAP = {
+    "instant": "llama-3.1-8b-instant",
+    "balanced": "llama-3.3-70b-versatile"
+}
+VISION_MODEL = "llama-3.2-11b-vision-preview"
+
+_INSTANT_MAX_WORDS = 80
+_EQUATION_RE = re.compile(r"[=^√\\$]|\b(?:log|sin|cos|tan)\b", re.IGNORECASE)
+_ADVANCED_MATH_RE = re.compile(
+    r"[∫∑]|\b(?:derivative|integral|limit|matrix|prove)\b|مشتق|تكامل|نهاية|مصفوفة|برهن|اثبت",
+    re.IGNORECASE
+)
+
+# Output budget per difficulty level - generation time grows with output
+# length, so simple questions ask for much less
+MAX_TOKENS_BY_LEVEL = {
+    "simple": 512,
+    "medium": 1500,
+    "complex": 2000
+}
+GROQ_MAX_TOKENS_CAP = int(os.getenv("GROQ_MAX_TOKENS_CAP", "2000"))
+
+
+def classify_level(text: Optional[str], has_image: bool = False) -> str:
+    """Rate a problem simple, medium or complex from its text"""
+    if has_image or not text or _ADVANCED_MATH_RE.search(text):
+        return "complex"
+    if len(text.split()) >= _INSTANT_MAX_WORDS or _EQUATION_RE.search(text):
+        return "medium"
+    return "simple"
+
+
+def classify_difficulty(text: Optional[str]) -> str:
+    """Pick a model tier: instant for short plain questions, balanced otherwise"""
+    return "instant" if classify_level(text) == "simple" else "balanced"
+
+
+def max_tokens_for(level: str) -> int:
+    """Output token budget for a difficulty level"""
+    return min(MAX_TOKENS_BY_LEVEL[level], GROQ_MAX_TOKENS_CAP)
+
+
+def _cache_key(model: str, messages: list) -> str:
+    """Build the response cache key from the model and messages"""
+    raw = model.encode("utf-8") + b"|" + orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+    return f"groq:{model}:{xxhash.xxh3_128_hexdigest(raw)}"
+
+
+async def _cache_get(state: State, key: str) -> Optional[dict]:
+    """Look a response up in the local cache, then in Redis"""
+    cached = state.cache.get(key)
+    if cached is not None or state.redis is None:
+        return cached
+    
+    try:
+        raw = await state.redis.get(key)
+        if raw is None:
+            return None
+        cached = orjson.loads(raw)
+    except (aioredis.RedisError, orjson.JSONDecodeError) as e:
+        print(f"⚠️ Redis get failed: {str(e)}")
+        return None
+    
+    state.cache[key] = cached
+    return cached
+
+
+async def _cache_set(state: State, key: str, data: dict):
+    """Store a response locally and, when configured, in Redis"""
+    state.cache[key] = data
+    if state.redis is None:
+        return
+    
+    try:
+        await state.redis.setex(key, CACHE_TTL, orjson.dumps(data))
+    except aioredis.RedisError as e:
+        print(f"⚠️ Redis set failed: {str(e)}")
+
+
+def downscale_image(file, mime_type: str) -> Optional[bytes]:
+    """
+    Shrink an image to MAX_IMAGE_EDGE, or return None if it already fits
+    
+    Raises Image.DecompressionBombError for images over MAX_IMAGE_PIXELS,
+    checked from the header before any pixel data is decoded.
+    """
+    try:
+        with Image.open(file) as img:
+            if img.width * img.height > MAX_IMAGE_PIXELS:
+                raise Image.DecompressionBombError(
+                    f"Image has {img.width * img.height} pixels, limit is {MAX_IMAGE_PIXELS}"
+                )
+            if max(img.size) <= MAX_IMAGE_EDGE:
+                return None
+            
+            # Re-encoding drops EXIF, so apply its orientation first or phone
+            # photos reach the model sideways
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            if mime_type == "image/jpeg" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            
+            output = io.BytesIO()
+            img.save(output, format=SUPPORTED_IMAGE_TYPES[mime_type])
+            return output.getvalue()
+    finally:
+        file.seek(0)
+
+
+async def encode_image_data_url(image: UploadFile, mime_type: str) -> tuple[str, int]:
+    """Stream an upload into a base64 data URL, returning (url, size in bytes)"""
+    buffer = bytearray(f"data:{mime_type};base64,".encode("ascii"))
+    size = 0
+    pending = b""
+    
+    while chunk := await image.read(_IMAGE_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        
+        # Carry any bytes past a 3-byte boundary so chunks encode without padding
+        chunk = pending + chunk
+        cut = len(chunk) - len(chunk) % 3
+        buffer += base64.b64encode(chunk[:cut])
+        pending = chunk[cut:]
+    
+    buffer += base64.b64encode(pending)
+    return buffer.decode("ascii"), size
 
-async def call_groq_api(messages: list, model: str = "llama-3.3-70b-versatile", has_image: bool = False) -> dict:
-    """Call Groq API directly using httpx"""
+
+async def _acquire_groq_slot(state: State):
+    """Wait for one of the GROQ_MAX_INFLIGHT upstream slots"""
+    state.groq_waiting += 1
+    try:
+        await state.groq_sem.acquire()
+    finally:
+        state.groq_waiting -= 1
+    state.groq_inflight += 1
+
+
+def _release_groq_slot(state: State):
+    """Give back a slot taken with _acquire_groq_slot"""
+    state.groq_inflight -= 1
+    state.groq_sem.release()
+
+
+
+def _encode_payload(payload: dict) -> bytes:
+    """Serialise a Groq payload, splicing in the pre-encoded system message"""
+    messages = payload["messages"]
+    if not messages or messages[0] is not _SYSTEM_MSG:
+        return orjson.dumps(payload)
+    
+    head = orjson.dumps({key: value for key, value in payload.items() if key != "messages"})
+    if len(messages) > 1:
+        encoded = b"[" + _SYSTEM_MSG_BYTES + b"," + orjson.dumps(messages[1:])[1:]
+    else:
+        encoded = b"[" + _SYSTEM_MSG_BYTES + b"]"
+    return head[:-1] + b',"messages":' + encoded + b"}"
+
+
+async def _send_groq_request(state: State, payload: dict, stream: bool = False) -> httpx.Response:
+    """
+    POST a payload to Groq within the concurrency limit, retrying 429/503
+    
+    Each attempt takes its own upstream slot, so backoff sleeps never hold
+    one. Retry-After waits longer than _MAX_RETRY_DELAY (e.g. daily token
+    limits) are not retried. A buffered response is returned with its slot
+    released; a streamed response keeps it and the caller must release it.
+    """
+    body = _encode_payload(payload)
+    
+    for attempt in range(_MAX_RETRIES + 1):
+        await _acquire_groq_slot(state)
+        try:
+            request = state.http.build_request("POST", GROQ_API_URL, headers=GROQ_HEADERS, content=body)
+            response = await state.http.send(request, stream=stream)
+        except BaseException:
+            _release_groq_slot(state)
+            raise
+        
+        delay = None
+        if response.status_code in _RETRY_STATUSES and attempt < _MAX_RETRIES:
+            # Honour Retry-After when Groq sends it, otherwise back off exponentially
+            try:
+                delay = float(response.headers["retry-after"])
+            except (KeyError, ValueError):
+                delay = _RETRY_BASE_DELAY * 2 ** attempt
+            delay = None if delay > _MAX_RETRY_DELAY else delay + random.uniform(0, _RETRY_BASE_DELAY)
+        
+        if delay is None:
+            if not stream:
+                _release_groq_slot(state)
+            return response
+        
+        await response.aclose()
+        _release_groq_slot(state)
+        
+        print(f"⚠️ Groq returned {response.status_code}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+async def _fetch_completion(state: State, payload: dict) -> dict:
+    """Make one buffered Groq call within the concurrency limit"""
+    response = await _send_groq_request(state, payload)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def _is_batchable(payload: dict) -> bool:
+    """Only single-turn text questions for the instant model are batched"""
+    messages = payload["messages"]
+    return (
+        payload["model"] == SPEED_MAP["instant"]
+        and len(messages) == 2
+        and messages[0] is _SYSTEM_MSG
+        and isinstance(messages[1]["content"], str)
+    )
+
+
+class GroqBatcher:
+    """
+    Merge concurrent standalone questions into a single Groq call
+    
+    Requests queued within wait_ms of the first are grouped by model and
+    sampling parameters, sent as one JSON task list and demultiplexed by
+    task_id. Any task missing from the batched answer, or every task when
+    Groq rejects the batched call with a 400, falls back to its own call.
+    """
+    
+    def __init__(self, state: State, max_batch: int, wait_ms: float):
+        self.state = state
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+    
+    async def submit(self, payload: dict) -> tuple[dict, bool]:
+        """Queue a payload and wait for (completion, whether it came from a batch)"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((payload, future))
+        return await future
+    
+    async def aclose(self):
+        """Stop the background collector"""
+        if self._worker is not None:
+            self._worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._worker
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.wait
+            
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            groups = {}
+            for payload, future in items:
+                key = (payload["model"], payload["temperature"], payload["max_tokens"])
+                groups.setdefault(key, []).append((payload, future))
+            
+            for group in groups.values():
+                self._spawn(self._dispatch(group))
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _resolve(self, future: asyncio.Future, payload: dict):
+        try:
+            result = await _fetch_completion(self.state, payload)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result((result, False))
+    
+    def _fail(self, group: list, error: Exception):
+        for _, future in group:
+            if not future.done():
+                future.set_exception(error)
+    
+    async def _dispatch(self, group: list):
+        if len(group) == 1:
+            payload, future = group[0]
+            await self._resolve(future, payload)
+            return
+        
+        # Only a problem with the batch itself - Groq rejecting invalid JSON
+        # output with a 400 - leaves every task to its own call. Rate limits,
+        # server errors and timeouts would hit the single calls too, so they
+        # fail the whole group
+        try:
+            answers = await self._call_batched([payload for payload, _ in group])
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                self._fail(group, e)
+                return
+            print(f"⚠️ Batched Groq call rejected, falling back to single calls: {str(e)}")
+            answers = {}
+        except Exception as e:
+            self._fail(group, e)
+            return
+        
+        for task_id, (payload, future) in enumerate(group):
+            if task_id in answers:
+                if not future.done():
+                    future.set_result((answers[task_id], True))
+            else:
+                self._spawn(self._resolve(future, payload))
+    
+    async def _call_batched(self, payloads: list) -> dict:
+        """Send payloads as one task list, returning completions by task_id"""
+        first = payloads[0]
+        tasks = [
+            {"task_id": task_id, "problem": payload["messages"][1]["content"]}
+            for task_id, payload in enumerate(payloads)
+        ]
+        batch_payload = {
+            "model": first["model"],
+            "messages": [
+                _SYSTEM_MSG,
+                {"role": "user", "content": _BATCH_INSTRUCTION + orjson.dumps(tasks).decode("utf-8")}
+            ],
+            "temperature": first["temperature"],
+            "max_tokens": min(first["max_tokens"] * len(payloads), _BATCH_MAX_TOKENS),
+            "response_format": {"type": "json_object"}
+        }
+        
+        data = await _fetch_completion(self.state, batch_payload)
+        
+        # Unparseable output leaves every task to the single-call fallback
+        try:
+            content = data["choices"][0]["message"]["content"]
+            answers = orjson.loads(content)["answers"]
+        except (KeyError, IndexError, TypeError, orjson.JSONDecodeError):
+            return {}
+        
+        results = {}
+        for answer in answers:
+            if not isinstance(answer, dict):
+                continue
+            task_id = answer.get("task_id")
+            text = answer.get("response")
+            if isinstance(task_id, int) and 0 <= task_id < len(payloads) and isinstance(text, str):
+                # Usage is left out - Groq only reports it for the whole batch
+                results[task_id] = {
+                    "model": data.get("model", first["model"]),
+                    "choices": [{"message": {"role": "assistant", "content": text}}]
+                }
+        return results
+
+
+def _finished(data: dict) -> bool:
+    """Whether a completion ended naturally rather than at max_tokens"""
+    try:
+        return data["choices"][0].get("finish_reason") == "stop"
+    except (KeyError, IndexError, TypeError):
+        return False
+
+
+async def call_groq_api(state: State, messages: list, model: str = SPEED_MAP["balanced"], has_image: bool = False, temperature: float = 0.7, max_tokens: int = 2000) -> dict:
+    """
+    Call Groq API directly using httpx, serving deterministic calls from cache
+    
+    Identical deterministic calls arriving while one is already in flight
+    wait for that call's result instead of reaching Groq themselves.
+    """
     
     # Use vision model if image present
     if has_image:
-        model = "llama-3.2-11b-vision-preview"
+        model = VISION_MODEL
     
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
+    cache_key = None
+    future = None
+    if temperature == 0:
+        cache_key = _cache_key(model, messages)
+        cached = await _cache_get(state, cache_key)
+        if cached is not None:
+            return cached
+        
+        pending = state.inflight.get(cache_key)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # Only fall through when the original caller went away
+                if not pending.cancelled():
+                    raise
+        
+        future = asyncio.get_running_loop().create_future()
+        state.inflight[cache_key] = future
+    
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
     }
     
+    try:
+        # Standalone questions on the instant tier can share a batched call.
+        # Batched answers were written alongside other students' problems,
+        # so only answers from a call of their own are cached
+        batched = False
+        if GROQ_BATCH_MAX > 1 and _is_batchable(payload):
+            data, batched = await state.batcher.submit(payload)
+        else:
+            data = await _fetch_completion(state, payload)
+        
+        if cache_key is not None and not batched and _finished(data):
+            await _cache_set(state, cache_key, data)
+    except asyncio.CancelledError:
+        if future is not None:
+            future.cancel()
+        raise
+    except Exception as e:
+        if future is not None:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+        raise
+    else:
+        if future is not None:
+            future.set_result(data)
+    finally:
+        if cache_key is not None and state.inflight.get(cache_key) is future:
+            del state.inflight[cache_key]
+    
+    return data
+
+
+def _sse_event(data: dict) -> bytes:
+    """Format a single Server-Sent Event"""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+async def _sse_from_cache(data: dict) -> AsyncIterator[bytes]:
+    """Replay a cached completion as a single SSE content event"""
+    yield _sse_event({"content": data["choices"][0]["message"]["content"]})
+    yield _sse_event({"done": True, "model": data.get("model"), "usage": data.get("usage", {})})
+
+
+async def _sse_from_groq(state: State, response: httpx.Response, model: str, cache_key: Optional[str]) -> AsyncIterator[bytes]:
+    """
+    Relay Groq's streamed deltas to the client as they arrive
+    
+    The answer is only treated as complete once Groq sends [DONE], and is
+    only cached when it also finished naturally rather than at max_tokens.
+    An in-stream error or a dropped connection ends the stream with an
+    error event instead. The upstream slot taken by
+    stream_groq_api is released when the generator finishes.
+    """
+    parts = []
+    usage = {}
+    finish_reason = None
+    error = None
+    completed = False
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            raw = line[len("data: "):]
+            if raw == "[DONE]":
+                completed = True
+                break
+            
+            chunk = orjson.loads(raw)
+            if chunk.get("error"):
+                error = chunk["error"]
+                break
+            
+            model = chunk.get("model", model)
+            usage = chunk.get("x_groq", {}).get("usage", usage)
+            
+            if not chunk.get("choices"):
+                continue
+            finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+            delta = chunk["choices"][0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                yield _sse_event({"content": delta})
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        error = str(e)
+    finally:
+        await response.aclose()
+        _release_groq_slot(state)
+    
+    if not completed:
+        error = error or "Stream ended before completion"
+        print(f"❌ Groq stream error: {error}")
+        yield _sse_event({"error": error})
+        return
+    
+    yield _sse_event({"done": True, "model": model, "usage": usage})
+    
+    # Store the assembled answer in the same shape as a buffered response
+    if cache_key is not None and finish_reason == "stop":
+        await _cache_set(state, cache_key, {
+            "model": model,
+            "choices": [{
+                "message": {"role": "assistant", "content": "".join(parts)},
+                "finish_reason": finish_reason
+            }],
+            "usage": usage
+        })
+
+
+async def _prepend_event(first: bytes, events: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yield an already-read event followed by the rest of the stream"""
+    yield first
+    async for event in events:
+        yield event
+
+
+async def stream_groq_api(state: State, messages: list, model: str = SPEED_MAP["balanced"], has_image: bool = False, temperature: float = 0.7, max_tokens: int = 2000) -> AsyncIterator[bytes]:
+    """
+    Start a streaming Groq call and return an SSE generator of its deltas
+    
+    The upstream request is opened before returning so HTTP errors surface
+    to the handler instead of in the middle of the event stream. Cache hits
+    are replayed without calling Groq. The concurrency slot is held until
+    the whole generation has been relayed.
+    """
+    
+    # Use vision model if image present
+    if has_image:
+        model = VISION_MODEL
+    
+    cache_key = None
+    if temperature == 0:
+        cache_key = _cache_key(model, messages)
+        cached = await _cache_get(state, cache_key)
+        if cached is not None:
+            return _sse_from_cache(cached)
+    
     payload = {
         "model": model,
         "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 2000
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True
     }
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(GROQ_API_URL, headers=headers, json=payload)
+    response = await _send_groq_request(state, payload, stream=True)
+    if response.is_error:
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+            _release_groq_slot(state)
         response.raise_for_status()
-        return response.json()
+    
+    # Start the generator before handing it over - a generator that never
+    # starts skips its finally, which would leak the slot if the client
+    # disconnects before the first event
+    events = _sse_from_groq(state, response, model, cache_key)
+    first = await events.__anext__()
+    return _prepend_event(first, events)
 
 
 @app.get("/")
@@ -197,19 +879,26 @@ async def root():
 
 
 @app.get("/health")
-async def health():
+async def health(request: Request):
     """Detailed health check"""
+    state = request.app.state
     return {
         "status": "healthy",
         "api_key_configured": bool(GROQ_API_KEY),
-        "groq_api_url": GROQ_API_URL
+        "groq_api_url": GROQ_API_URL,
+        "groq_inflight": state.groq_inflight,
+        "groq_queue_depth": state.groq_waiting,
+        "groq_max_inflight": GROQ_MAX_INFLIGHT,
+        "redis_configured": state.redis is not None
     }
 
 
 @app.post("/solve")
 async def solve_problem(
+    request: Request,
     problem_text: Optional[str] = Form(None),
-    image: Optional[UploadFile] = File(None)
+    image: Optional[UploadFile] = File(None),
+    stream: bool = Form(False)
 ):
     """
     Solve a math problem from text or image
@@ -217,9 +906,11 @@ async def solve_problem(
     Args:
         problem_text: Text description of the problem
         image: Image file containing the problem
+        stream: Stream the solution as Server-Sent Events
     
     Returns:
-        JSON with solution, explanation, and teaching content
+        JSON with solution, explanation, and teaching content, or an
+        SSE stream of content deltas when stream is set
     """
     try:
         if not problem_text and not image:
@@ -229,29 +920,38 @@ async def solve_problem(
             )
         
         # Prepare messages for Groq API
-        messages = [
-            {"role": "system", "content": MASTER_TUTOR_PROMPT}
-        ]
+        messages = [_SYSTEM_MSG]
         
         # Handle image upload
         if image:
+            # Reject non-image and oversize uploads before reading them
+            mime_type = image.content_type
+            if mime_type not in SUPPORTED_IMAGE_TYPES:
+                raise HTTPException(
+                    status_code=415,
+                    detail=f"Unsupported image type: {mime_type}. Use JPEG, PNG, GIF or WebP"
+                )
+            if image.size is not None and image.size > MAX_IMAGE_BYTES:
+                raise HTTPException(status_code=413, detail="Image is too large")
+            
             try:
-                # Read image and convert to base64
-                image_data = await image.read()
-                base64_image = base64.b64encode(image_data).decode('utf-8')
-                
-                # Determine image mime type - Groq supports JPEG, PNG, GIF, WebP
-                mime_type = image.content_type or "image/jpeg"
+                # Shrink large images off the event loop, then convert to a base64 data URL
+                try:
+                    resized = await asyncio.to_thread(downscale_image, image.file, mime_type)
+                except Image.DecompressionBombError:
+                    raise HTTPException(status_code=413, detail="Image dimensions are too large")
+                except UnidentifiedImageError:
+                    raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
                 
-                # Validate mime type
-                supported_types = ["image/jpeg", "image/png", "image/gif", "image/webp"]
-                if mime_type not in supported_types:
-                    # Default to jpeg if unsupported
-                    mime_type = "image/jpeg"
+                if resized is not None:
+                    image_url = f"data:{mime_type};base64,{base64.b64encode(resized).decode('ascii')}"
+                    image_size = len(resized)
+                else:
+                    image_url, image_size = await encode_image_data_url(image, mime_type)
                 
                 # Detect language from problem_text
-                is_arabic = problem_text and any('\u0600' <= c <= '\u06FF' for c in problem_text)
-                instruction = "حل هذه المسألة من الصورة بالتفصيل بالعربي." if is_arabic else problem_text or "Solve this math problem from the image in detail."
+                is_arabic = bool(problem_text and _ARABIC_RE.search(problem_text))
+                instruction = _AR_IMAGE_INSTRUCTION if is_arabic else problem_text or _EN_IMAGE_INSTRUCTION
                 
                 # FIXED: Correct format for Groq vision API
                 # The content should be a list with text and image_url objects
@@ -265,25 +965,27 @@ async def solve_problem(
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:{mime_type};base64,{base64_image}"
+                                "url": image_url
                             }
                         }
                     ]
                 }
                 
-                print(f"✅ Image processed: {mime_type}, size: {len(image_data)} bytes")
+                print(f"✅ Image processed: {mime_type}, size: {image_size} bytes")
                 
+            except HTTPException:
+                raise
             except Exception as e:
                 print(f"❌ Image processing error: {str(e)}")
                 raise HTTPException(status_code=400, detail=f"Image processing error: {str(e)}")
         else:
             # Text-only problem - detect language
-            is_arabic = any('\u0600' <= c <= '\u06FF' for c in problem_text)
+            is_arabic = bool(problem_text and _ARABIC_RE.search(problem_text))
             
             if is_arabic:
-                instruction = f"{problem_text}\n\nمهم: أجب بالكامل باللهجة الشامية السورية فقط!"
+                instruction = "".join((problem_text, _AR_SUFFIX))
             else:
-                instruction = f"{problem_text}\n\nProvide adaptive teaching based on the problem difficulty."
+                instruction = "".join((problem_text, _EN_SUFFIX))
             
             user_message = {
                 "role": "user",
@@ -292,11 +994,34 @@ async def solve_problem(
         
         messages.append(user_message)
         
-        # Call Groq API with vision if image present
-        print(f"📤 Calling Groq API with model: {'llama-3.2-11b-vision-preview' if image else 'llama-3.3-70b-versatile'}")
+        # Call Groq API with vision if image present, otherwise route by difficulty
+        level = classify_level(problem_text, has_image=bool(image))
+        model = VISION_MODEL if image else SPEED_MAP[classify_difficulty(problem_text)]
+        max_tokens = max_tokens_for(level)
+        print(f"📤 Calling Groq API with model: {model}, max_tokens: {max_tokens}")
         
         try:
-            response_data = await call_groq_api(messages, has_image=bool(image))
+            # Text-only problems are answered deterministically so repeated
+            # stock problems can be served from cache
+            if stream:
+                events = await stream_groq_api(
+                    request.app.state,
+                    messages,
+                    model=model,
+                    has_image=bool(image),
+                    temperature=0.7 if image else 0.0,
+                    max_tokens=max_tokens
+                )
+                return StreamingResponse(events, media_type="text/event-stream")
+            
+            response_data = await call_groq_api(
+                request.app.state,
+                messages,
+                model=model,
+                has_image=bool(image),
+                temperature=0.7 if image else 0.0,
+                max_tokens=max_tokens
+            )
         except httpx.HTTPStatusError as e:
             print(f"❌ Groq API HTTP Error: {e.response.status_code}")
             print(f"❌ Response content: {e.response.text}")
@@ -316,18 +1041,20 @@ async def solve_problem(
         
         print(f"✅ Solution generated successfully")
         
-        return JSONResponse(content={
+        return {
             "success": True,
             "solution": solution,
-            "model": response_data.get("model", "llama-3.3-70b-versatile"),
+            "model": response_data.get("model", model),
             "usage": response_data.get("usage", {}),
             "metadata": {
                 "has_image": image is not None,
                 "has_text": problem_text is not None,
                 "teaching_mode": "adaptive"
             }
-        })
+        }
         
+    except HTTPException:
+        raise
     except httpx.HTTPError as e:
         print(f"❌ HTTP Error in /solve: {str(e)}")
         raise HTTPException(
@@ -346,8 +1073,10 @@ async def solve_problem(
 
 @app.post("/chat")
 async def chat(
+    request: Request,
     message: str = Form(...),
-    conversation_history: Optional[str] = Form(None)
+    conversation_history: Optional[str] = Form(None),
+    stream: bool = Form(False)
 ):
     """
     Continue a conversation with the tutor
@@ -355,28 +1084,51 @@ async def chat(
     Args:
         message: User's message/question
         conversation_history: JSON string of previous messages
+        stream: Stream the response as Server-Sent Events
     
     Returns:
-        JSON with tutor's response
+        JSON with tutor's response, or an SSE stream of content deltas
+        when stream is set
     """
     try:
-        messages = [
-            {"role": "system", "content": MASTER_TUTOR_PROMPT}
-        ]
+        messages = [_SYSTEM_MSG]
         
         # Add conversation history if provided
         if conversation_history:
             try:
-                history = json.loads(conversation_history)
+                history = orjson.loads(conversation_history)
                 messages.extend(history)
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 pass  # Invalid JSON, ignore
         
         # Add current message
         messages.append({"role": "user", "content": message})
         
-        # Call Groq API
-        response_data = await call_groq_api(messages)
+        # Call Groq API - standalone questions are deterministic and cacheable
+        # Follow-ups ("why?", "explain step 3 again") lean on the earlier
+        # turns, so a conversation is never treated as a simple question
+        level = classify_level(message)
+        if len(messages) > 2 and level == "simple":
+            level = "medium"
+        model = SPEED_MAP["instant" if level == "simple" else "balanced"]
+        max_tokens = max_tokens_for(level)
+        if stream:
+            events = await stream_groq_api(
+                request.app.state,
+                messages,
+                model=model,
+                temperature=0.7 if conversation_history else 0.0,
+                max_tokens=max_tokens
+            )
+            return StreamingResponse(events, media_type="text/event-stream")
+        
+        response_data = await call_groq_api(
+            request.app.state,
+            messages,
+            model=model,
+            temperature=0.7 if conversation_history else 0.0,
+            max_tokens=max_tokens
+        )
         
         # Extract response
         if "choices" not in response_data or not response_data["choices"]:
@@ -387,11 +1139,11 @@ async def chat(
         
         response_text = response_data["choices"][0]["message"]["content"]
         
-        return JSONResponse(content={
+        return {
             "success": True,
             "response": response_text,
-            "model": response_data.get("model", "llama-3.3-70b-versatile")
-        })
+            "model": response_data.get("model", model)
+        }
         
     except httpx.HTTPError as e:
         raise HTTPException(
@@ -408,4 +1160,13 @@ async def chat(
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker imports the app separately and gets its own HTTP client and cache
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )